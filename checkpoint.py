@@ -0,0 +1,21 @@
+import collections
+import glob
+import os
+import shutil
+
+
+def load_best_paths(save_dir, keep=5):
+    # Best checkpoints from an earlier run still count towards the limit
+    past_best = glob.glob(os.path.join(save_dir, "model_best_*.pth.tar"))
+    return collections.deque(sorted(past_best, key=os.path.getmtime)[-keep:], maxlen=keep)
+
+
+def keep_best(path, best_path, best_paths):
+    # Copy path to best_path, dropping the oldest kept best once the deque is full
+    if len(best_paths) == best_paths.maxlen:
+        try:
+            os.remove(best_paths[0])
+        except FileNotFoundError:
+            pass
+    shutil.copyfile(path, best_path)
+    best_paths.append(best_path)
@@ -1,9 +1,10 @@
 import numpy as np
 import pandas as pd
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler, default_collate
 import torch
 from tqdm import tqdm
 import math
+import os
 
 
 class TextDataset(Dataset):
@@ -108,21 +109,120 @@ class TextEEDataset(Dataset):
         return string, self.default_ind
 
 
+def token_paths(path, model):
+    # e.g. dataset/split_val.csv -> dataset/split_val_bert_base_uncased_input_ids.npy
+    prefix = f"{os.path.splitext(path)[0]}_{model.replace('-', '_')}"
+    return f"{prefix}_input_ids.npy", f"{prefix}_attention_mask.npy"
+
+
+class TokenEEDataset(Dataset):
+    # TextEEDataset over the memory-mapped int32 tokens written by preprocess.py
+    def __init__(self, path, id_to_ind, default_ind, model, transform=False, test=False, seed=421):
+        # Reading and preprocessing dataset
+        self.transform = transform
+        self.test = test
+        print("========> LOADING DATASET <========")
+        ids_path, mask_path = token_paths(path, model)
+        if not (os.path.exists(ids_path) and os.path.exists(mask_path)):
+            # Imported here since preprocess imports token_paths from this module
+            from preprocess import tokenize_csv
+
+            print(f"No token cache for {path}, tokenizing once")
+            tokenize_csv(path, model)
+        self.input_ids = np.load(ids_path, mmap_mode="r")
+        self.attention_mask = np.load(mask_path, mmap_mode="r")
+        columns = ["PRODUCT_TYPE_ID"] if test else ["PRODUCT_TYPE_ID", "PRODUCT_LENGTH"]
+        self.data = pd.read_csv(path, usecols=columns)
+        self.mean = 6.5502
+        self.std = 0.9601
+        self.id_to_ind = id_to_ind
+        self.default_ind = default_ind
+        self.type_inds = (
+            self.data["PRODUCT_TYPE_ID"].map(id_to_ind).fillna(default_ind).to_numpy(np.int64)
+        )
+        if not test:
+            length = self.data["PRODUCT_LENGTH"].to_numpy(np.float64)
+            if self.transform:
+                length = (np.minimum(np.log(length), 12) - self.mean) / self.std
+            self.lengths = length.astype(np.float32)
+        if len(self.input_ids) != len(self.data):
+            raise ValueError(
+                f"{ids_path} has {len(self.input_ids)} rows but {path} has {len(self.data)}, "
+                "delete it or rerun preprocess.py"
+            )
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx):
+        inp = {
+            "input_ids": torch.from_numpy(self.input_ids[idx].copy()),
+            "attention_mask": torch.from_numpy(self.attention_mask[idx].copy()),
+        }
+        if not self.test:
+            return inp, self.type_inds[idx], self.lengths[idx]
+        return inp, self.type_inds[idx]
+
+    def token_counts(self):
+        # Number of non-padding tokens per row, used for length bucketing
+        return self.attention_mask.sum(axis=1)
+
+
+class LengthBucketSampler(Sampler):
+    # Batches rows of similar token count so trim_collate pads each batch only to its longest row
+    def __init__(self, lengths, batch_size, shuffle=True, seed=421):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        order = np.lexsort((rng.random(len(self.lengths)), self.lengths))
+        # The short last batch is kept, dropping it would skip the longest rows every epoch
+        batches = [order[i : i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        if self.shuffle:
+            rng.shuffle(batches)
+        for batch in batches:
+            yield batch.tolist()
+
+
+def trim_collate(batch, multiple=128):
+    # Cut the max_length padding down to the longest row in the batch, rounded up
+    # to a multiple of 128. That leaves only max_length / 128 distinct shapes, so a
+    # compiled model (reduce-overhead records a CUDA graph per shape) recompiles a
+    # handful of times rather than once per length. Rows are sliced before
+    # stacking so each batch tensor is allocated once, at its final size
+    inps = [item[0] for item in batch]
+    max_length = inps[0]["attention_mask"].shape[0]
+    length = max(int(inp["attention_mask"].sum()) for inp in inps)
+    length = min(-(-length // multiple) * multiple, max_length)
+    inp = {k: torch.stack([x[k][:length] for x in inps]) for k in inps[0]}
+    rest = default_collate([item[1:] for item in batch])
+    return (inp, *rest)
+
+
 class EmbeddingDataset(Dataset):
     def __init__(self, embeddings_path, csv_path, seed=421):
         # Reading and preprocessing dataset
         print("========> LOADING DATASET <========", flush=True)
-        self.targets = pd.read_csv(csv_path, usecols=["PRODUCT_LENGTH"]).reset_index()
-        self.embeddings = np.load(embeddings_path)
+        self.embeddings = np.load(embeddings_path, mmap_mode="r")
         self.mean = 6.5502
         self.std = 0.9601
+        length = pd.read_csv(csv_path, usecols=["PRODUCT_LENGTH"])["PRODUCT_LENGTH"].to_numpy()
+        length = (np.minimum(np.log(length), 12) - self.mean) / self.std
+        self.targets = torch.from_numpy(length.astype(np.float32))
 
     def __len__(self):
         return len(self.targets)
 
     def __getitem__(self, idx):
-        _, length = self.targets.iloc[idx]
-        length = (min(math.log(length), 12) - self.mean) / self.std
-        embedding = self.embeddings[idx]
+        # Copy the row out of the read-only memmap so torch gets a writable buffer
+        embedding = torch.from_numpy(self.embeddings[idx].copy())
 
-        return embedding, length
+        return embedding, self.targets[idx]
@@ -3,6 +3,7 @@ import builtins
 import glob
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 import pandas as pd
 
@@ -12,11 +13,14 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
-from dataset import TextDataset, TextEEDataset
+from checkpoint import keep_best, load_best_paths
+from dataset import LengthBucketSampler, TextDataset, TextEEDataset, TokenEEDataset, trim_collate
 from model import TransformerEntityRegressor, TransformerEntityRegressorOld
 
 builtins.print = partial(print, flush=True)
 
+loss_fn = torch.nn.MSELoss()
+
 
 def train(model, optimizer, train_loader, val_loader, args):
     print("In train function")
@@ -24,107 +28,261 @@ def train(model, optimizer, train_loader, val_loader, args):
         print(f"Epoch: {epoch}")
         args.epoch = epoch
         train_loss = train_one_epoch(model, optimizer, train_loader, val_loader, args)
-
-
-def save_checkpoint(state, is_best, args):
-    torch.save(state, os.path.join(args.save_dir, f"iter_{state['iter']}.pth.tar"))
-    last_epoch_path = os.path.join(
-        args.save_dir, f"iter_{state['iter'] - args.save_every*args.batch_size}.pth.tar"
-    )
-
+    # Make sure the last checkpoint is on disk before exiting
+    args.save_executor.shutdown(wait=True)
+    if args.save_future is not None:
+        args.save_future.result()
+
+
+def to_cpu(obj):
+    if torch.is_tensor(obj):
+        # copy: on a CPU run .to("cpu") would hand back the live tensor itself
+        return obj.detach().to("cpu", non_blocking=True, copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def write_checkpoint(state, is_best, args):
+    path = os.path.join(args.save_dir, f"iter_{state['iter']}.pth.tar")
+    torch.save(state, path)
+    # last_epoch_path = os.path.join(
+    #     args.save_dir, f"iter_{state['iter'] - args.save_every*args.batch_size}.pth.tar"
+    # )
     # try:
     #     os.remove(last_epoch_path)
     # except OSError:
     #     pass
 
-    # if is_best:
-    #     past_best = glob.glob(os.path.join(args.save_dir, "model_best_*.pth.tar"))
-    #     past_best = sorted(past_best, key=lambda x: int("".join(filter(str.isdigit, x))))
-    #     if len(past_best) >= 5:
-    #         try:
-    #             os.remove(past_best[0])
-    #         except:
-    #             pass
-    #     torch.save(state, os.path.join(args.save_dir, f"model_best_iter_{state['iter']}.pth.tar"))
+    if is_best and args.keep_best:
+        best_path = os.path.join(args.save_dir, f"model_best_iter_{state['iter']}.pth.tar")
+        keep_best(path, best_path, args.best_paths)
+
+
+def save_checkpoint(state, is_best, args):
+    # Wait for the previous write so at most one host copy of the state is alive
+    if args.save_future is not None:
+        args.save_future.result()
+    # Training keeps updating the tensors in place, so the background thread
+    # must serialize a host snapshot of them
+    state = to_cpu(state)
+    if args.device.type == "cuda":
+        torch.cuda.current_stream().synchronize()
+    args.save_future = args.save_executor.submit(write_checkpoint, state, is_best, args)
+
+
+def save_model(model, optimizer, args):
+    state = {
+        "epoch": args.epoch,
+        "iter": args.iter,
+        "state_dict": model.state_dict(),
+        "best_val_mape": args.best_val_mape,
+        "optimizer": optimizer.state_dict(),
+        "scaler": args.scaler.state_dict(),
+    }
+    # Only the weights that were actually validated can be tagged as best
+    save_checkpoint(state, args.best_iter == args.iter, args)
+    print("Saved model")
+
+
+def to_device(inp, args):
+    return {k: v.to(args.device, non_blocking=True) for k, v in inp.items()}
+
+
+def forward_backward(model, inp, x, y, args):
+    # The autocast weight cache must be off while capturing a CUDA graph
+    with torch.cuda.amp.autocast(enabled=args.amp, cache_enabled=not args.cuda_graph):
+        output = model(inp, x)
+        loss = loss_fn(output.squeeze(), y)
+    # loss = torch.mean(torch.abs(output - y) / (torch.abs(y) + 1e-8))
+    # Gradients of accum_steps micro-batches add up to the mean over the whole batch
+    args.scaler.scale(loss / args.accum_steps).backward()
+    return loss
+
+
+def optimizer_step(model, optimizer, args):
+    # Unscale before clipping so the threshold applies to the real gradients
+    args.scaler.unscale_(optimizer)
+    torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+    args.scaler.step(optimizer)
+    args.scaler.update()
+
+
+def graphed_train_step(model, optimizer, inp, x, y, args):
+    # Warm up eagerly on a side stream, then capture the step once and replay it
+    if args.static is None:
+        args.static = {
+            "inp": {k: v.clone() for k, v in inp.items()},
+            "x": x.clone(),
+            "y": y.clone(),
+        }
+    static = args.static
+    for k, v in inp.items():
+        static["inp"][k].copy_(v, non_blocking=True)
+    static["x"].copy_(x, non_blocking=True)
+    static["y"].copy_(y, non_blocking=True)
+
+    if args.graph_warmup < args.graph_warmup_iters:
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            optimizer.zero_grad(set_to_none=True)
+            loss = forward_backward(model, static["inp"], static["x"], static["y"], args)
+            optimizer_step(model, optimizer, args)
+        torch.cuda.current_stream().wait_stream(stream)
+        args.graph_warmup += 1
+        return loss
+
+    if args.graph is None:
+        print("Capturing CUDA graph")
+        args.graph = torch.cuda.CUDAGraph()
+        # Gradients allocated during capture live in the graph's pool and are
+        # overwritten (not accumulated) on every replay, so never zero them again
+        optimizer.zero_grad(set_to_none=True)
+        with torch.cuda.graph(args.graph):
+            static["loss"] = forward_backward(
+                model, static["inp"], static["x"], static["y"], args
+            )
+            # The GradScaler step syncs with the host, so it stays outside the graph
+            if not args.amp:
+                optimizer_step(model, optimizer, args)
+
+    args.graph.replay()
+    if args.amp:
+        optimizer_step(model, optimizer, args)
+    return static["loss"]
 
 
 def train_one_epoch(model, optimizer, train_loader, val_loader, args):
     model.train()
-    loss_fn = torch.nn.MSELoss()
-    losses = []
+    # Accumulate on the device so the loop never waits on a host sync
+    loss_sum = torch.zeros((), device=args.device)
+    n = 0
+    if not args.cuda_graph:
+        optimizer.zero_grad(set_to_none=True)
     batch_start_time = time.time()
-    for i, (string, x, y) in enumerate(train_loader):
+    for i, (inp, x, y) in enumerate(train_loader):
         B = len(y)
-        output = model(string=string, type_id=x, device=args.device)
-        y = y.to(args.device)
-        loss = loss_fn(output.squeeze(), y.to(args.device))
-        # loss = torch.mean(torch.abs(output - y) / (torch.abs(y) + 1e-8))
+        inp = to_device(inp, args)
+        x = x.to(args.device, non_blocking=True)
+        y = y.to(args.device, non_blocking=True)
+        if args.cuda_graph:
+            loss = graphed_train_step(model, optimizer, inp, x, y, args)
+        else:
+            loss = forward_backward(model, inp, x, y, args)
+            # Also step on the last batch so a short final group isn't zeroed unused
+            if (i + 1) % args.accum_steps == 0 or i + 1 == len(train_loader):
+                optimizer_step(model, optimizer, args)
+                optimizer.zero_grad(set_to_none=True)
+
+        loss_sum += loss.detach()
+        n += 1
 
-        optimizer.zero_grad()
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
-        optimizer.step()
+        if args.pending_val is not None and args.pending_val["done"].query():
+            finish_val(args)
 
-        losses.append(loss.item())
+        save = i % args.save_every == 0
+        if save and not args.keep_best:
+            # Snapshot before queueing validation so the copy doesn't wait for it
+            save_model(model, optimizer, args)
 
         if i % args.val_every == 0:
+            flush_train_log(args)
+            if args.pending_val is not None:
+                finish_val(args)
             print("Validating...")
-            val_time = time.time()
-            train_loss = np.mean(losses)
-            val_loss, val_mape = val(model, val_loader, args)
-            print(
-                f"Train Loss: {train_loss:.4f} | Val Loss: {val_loss} | Val MAPE: {val_mape} | Best Val MAPE: {args.best_val_mape}"
-            )
-            args.writer.add_scalar("Val/loss", val_loss, args.iter)
-            args.writer.add_scalar("Val/MAPE", val_mape, args.iter)
-            is_best = val_mape < args.best_val_mape
-            if is_best:
-                args.best_val_mape = val_mape
-            print(f"Val time: {time.time() - val_time}")
-
-        if i % args.save_every == 0:
-            state = {
-                "epoch": args.epoch,
-                "iter": args.iter,
-                "state_dict": model.state_dict(),
-                "best_val_mape": args.best_val_mape,
-                "optimizer": optimizer.state_dict(),
-            }
-            save_checkpoint(state, is_best, args)
-            print("Saved model")
+            start_val(model, val_loader, loss_sum / n, args)
+
+        if save and args.keep_best:
+            # Tagging as best needs the verdict on these weights, so wait for it
+            if args.pending_val is not None:
+                finish_val(args)
+            save_model(model, optimizer, args)
 
         if i % args.log_every == 0:
-            print(f"[{i}] Loss: {loss.item()}")
-            args.writer.add_scalar("Train/loss", loss.item(), args.iter)
+            # clone: with --cuda_graph the loss tensor is overwritten by the next replay
+            args.log_buffer.append((args.iter, loss.detach().clone()))
 
-        torch.cuda.empty_cache()
         print(f"[{i}] Batch time: {time.time() - batch_start_time}")
         batch_start_time = time.time()
         args.iter += B
 
-    return np.mean(losses)
+    flush_train_log(args)
+    if args.pending_val is not None:
+        finish_val(args)
+    return (loss_sum / n).item()
+
+
+def flush_train_log(args):
+    # Write the buffered train losses with a single host sync
+    if not args.log_buffer:
+        return
+    iters, losses = zip(*args.log_buffer)
+    losses = torch.stack(losses).tolist()
+    for it, loss in zip(iters, losses):
+        args.writer.add_scalar("Train/loss", loss, it)
+    args.writer.flush()
+    print(f"[{iters[-1]}] Loss: {losses[-1]} | Mean of last {len(losses)}: {np.mean(losses):.4f}")
+    args.log_buffer = []
+
+
+def start_val(model, val_loader, train_loss, args):
+    # Queue validation without a host sync; finish_val reads the metrics back later
+    pending = {"iter": args.iter, "train_loss": train_loss}
+    pending["val_loss"], pending["val_mape"] = val(model, val_loader, args)
+    model.train()
+    args.pending_val = pending
+    if args.device.type == "cuda":
+        pending["done"] = torch.cuda.Event()
+        pending["done"].record()
+    else:
+        finish_val(args)
+
+
+def finish_val(args):
+    pending = args.pending_val
+    args.pending_val = None
+    if "done" in pending:
+        pending["done"].synchronize()
+    train_loss = pending["train_loss"].item()
+    val_loss = pending["val_loss"].item()
+    val_mape = pending["val_mape"].item()
+    print(
+        f"Train Loss: {train_loss:.4f} | Val Loss: {val_loss} | Val MAPE: {val_mape} | Best Val MAPE: {args.best_val_mape}"
+    )
+    args.writer.add_scalar("Val/loss", val_loss, pending["iter"])
+    args.writer.add_scalar("Val/MAPE", val_mape, pending["iter"])
+    if val_mape < args.best_val_mape:
+        args.best_val_mape = val_mape
+        args.best_iter = pending["iter"]
 
 
 def val(model, val_loader, args):
     model.eval()
-    loss_fn = torch.nn.MSELoss()
-    losses = []
-    mape = 0
+    # fp64 accumulators, so summing many batches doesn't lose precision
+    loss_sum = torch.zeros((), dtype=torch.float64, device=args.device)
+    mape = torch.zeros((), dtype=torch.float64, device=args.device)
     with torch.no_grad():
         total = 0
-        for i, (string, x, y) in enumerate(tqdm(val_loader)):
+        for i, (inp, x, y) in enumerate(tqdm(val_loader)):
             total += len(y)
-            y = y.to(args.device)
-            output = model(string, x, device=args.device).squeeze()
+            y = y.to(args.device, non_blocking=True)
+            inp = to_device(inp, args)
+            with torch.cuda.amp.autocast(enabled=args.amp):
+                output = model(inp, x.to(args.device, non_blocking=True)).squeeze()
+            # Metrics are computed in fp32 regardless of the autocast dtype
+            output = output.float()
             loss = loss_fn(output, y)
-            losses.append(loss.item())
+            loss_sum += loss.double()
             if args.transform:
                 output = torch.exp(output * val_loader.dataset.std + val_loader.dataset.mean)
                 y = torch.exp(y * val_loader.dataset.std + val_loader.dataset.mean)
-            mape += torch.sum(torch.abs(output - y) / (torch.abs(y) + 1e-8))
+            mape += ((output - y).abs() / y.abs().clamp_min(1e-8)).sum().double()
             if i >= 100:
                 break
-    return np.mean(losses), mape.item() / total
+    return loss_sum / (i + 1), mape / total
 
 
 def main(args):
@@ -140,27 +298,45 @@ def main(args):
             default_ind += 1
         else:
             id_to_ind[k] = default_ind
-    train_set = TextEEDataset(
+    train_set = TokenEEDataset(
         path="dataset/train.csv",
         id_to_ind=id_to_ind,
         default_ind=default_ind,
+        model=args.model,
         transform=args.transform,
     )
-    val_set = TextEEDataset(
+    val_set = TokenEEDataset(
         path="dataset/split_val.csv",
         id_to_ind=id_to_ind,
         default_ind=default_ind,
+        model=args.model,
         transform=args.transform,
     )
 
     print(f"Train set size: {len(train_set)}")
     print(f"Val set size: {len(val_set)}")
 
-    train_loader = DataLoader(
-        train_set, batch_size=args.batch_size, num_workers=args.num_workers, shuffle=True
-    )
+    loader_kwargs = {"num_workers": args.num_workers, "pin_memory": args.device.type == "cuda"}
+    if args.num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+    if args.bucket:
+        train_sampler = LengthBucketSampler(train_set.token_counts(), args.batch_size, shuffle=True)
+        train_loader = DataLoader(
+            train_set, batch_sampler=train_sampler, collate_fn=trim_collate, **loader_kwargs
+        )
+    else:
+        # drop_last keeps every batch the same shape, which a captured CUDA graph needs
+        train_loader = DataLoader(
+            train_set, batch_size=args.batch_size, shuffle=True, drop_last=True, **loader_kwargs
+        )
+    # Validation never goes through the --cuda_graph capture; trim_collate pads to a
+    # few fixed lengths, which bounds how often the compiled model re-specializes
     val_loader = DataLoader(
-        val_set, batch_size=args.batch_size * 2, num_workers=args.num_workers, shuffle=False
+        val_set,
+        batch_size=args.batch_size * 2,
+        shuffle=False,
+        collate_fn=trim_collate,
+        **loader_kwargs,
     )
     print(f"Train loader size: {len(train_loader)}")
     print(f"Val loader size: {len(val_loader)}")
@@ -169,25 +345,57 @@ def main(args):
     model = TransformerEntityRegressorOld(
         transformer=args.model, embedding_dim=32, num_embeddings=len(id_to_ind)
     ).to(args.device)
-    params = []
-    for n, p in model.named_parameters():
-        if "transformer" in n:
-            params.append({"params": p, "lr": args.lr / 10})
-        else:
-            params.append({"params": p, "lr": args.lr})
+    args.pending_val = None
+    args.best_iter = None
+    if not args.no_compile and hasattr(model, "compile"):
+        # Compiles in place, so state_dict keys stay compatible with old checkpoints.
+        # Inductor's own CUDA graphs would clash with our manually captured one.
+        mode = "max-autotune-no-cudagraphs" if args.cuda_graph else "reduce-overhead"
+        print(f"Compiling model with mode={mode}")
+        model.compile(mode=mode, fullgraph=False)
+    # Two groups rather than one per tensor, so a fused optimizer launches one kernel per group
+    transformer_params = [p for n, p in model.named_parameters() if "transformer" in n]
+    other_params = [p for n, p in model.named_parameters() if "transformer" not in n]
+    params = [{"params": other_params, "lr": args.lr}]
+    if args.freeze_transformer:
+        # No backward through BERT at all, only the embedding and regressor train
+        for p in transformer_params:
+            p.requires_grad_(False)
+    else:
+        params.append({"params": transformer_params, "lr": args.lr / 10})
 
-    optimizer = torch.optim.Adam(params, lr=args.lr, amsgrad=True)
+    args.amp = args.device.type == "cuda" and not args.no_amp
+    fused = args.device.type == "cuda"
+    # capturable keeps the step counter on the GPU so the step can be graphed
+    if args.optimizer == "adamw":
+        optimizer = torch.optim.AdamW(params, lr=args.lr, fused=fused, capturable=args.cuda_graph)
+    else:
+        optimizer = torch.optim.Adam(
+            params, lr=args.lr, amsgrad=True, fused=fused, capturable=args.cuda_graph
+        )
+    args.scaler = torch.cuda.amp.GradScaler(enabled=args.amp)
+    args.graph = None
+    args.static = None
+    args.graph_warmup = 0
 
     args.save_dir = f"checkpoints/{args.run_name}"
     os.makedirs(args.save_dir, exist_ok=True)
     os.makedirs(f"logs/{args.run_name}", exist_ok=True)
     args.writer = SummaryWriter(f"logs/{args.run_name}")
+    args.log_buffer = []
+    args.save_executor = ThreadPoolExecutor(max_workers=1)
+    args.save_future = None
+    if args.keep_best:
+        args.best_paths = load_best_paths(args.save_dir)
 
     if args.resume:
         print("Resuming from checkpoint")
         state = torch.load(args.resume)
         model.load_state_dict(state["state_dict"])
         # optimizer.load_state_dict(state["optimizer"])
+        # A disabled scaler (CPU or --no_amp run) saves {}, which load_state_dict rejects
+        if state.get("scaler") and args.scaler.is_enabled():
+            args.scaler.load_state_dict(state["scaler"])
         args.best_val_mape = state["best_val_mape"]
         args.start_epoch = state["epoch"] + 1
         args.iter = state["iter"]
@@ -214,11 +422,31 @@ if __name__ == "__main__":
     parser.add_argument("--run_name", type=str, default="v0")
     parser.add_argument("--resume", type=str, default="")
     parser.add_argument("--batch_size", type=int, default=32)
-    parser.add_argument("--num_workers", type=int, default=2)
+    parser.add_argument("--num_workers", type=int, default=min(8, os.cpu_count() or 1))
     parser.add_argument("--transform", type=bool, default=False)
+    parser.add_argument("--no_amp", action="store_true", help="Disable fp16 autocast")
+    parser.add_argument(
+        "--accum_steps", type=int, default=1, help="Micro-batches per optimizer step"
+    )
+    parser.add_argument(
+        "--cuda_graph", action="store_true", help="Replay the train step as a CUDA graph"
+    )
+    parser.add_argument("--graph_warmup_iters", type=int, default=3)
+    parser.add_argument("--no_compile", action="store_true", help="Run the model eagerly")
+    parser.add_argument("--optimizer", type=str, default="adam", choices=["adam", "adamw"])
+    parser.add_argument("--bucket", action="store_true", help="Batch by token count, pad per batch")
+    parser.add_argument("--freeze_transformer", action="store_true")
+    parser.add_argument(
+        "--keep_best", action="store_true", help="Also keep the last 5 best checkpoints"
+    )
 
     # Model
     parser.add_argument("--model", type=str, default="bert-base-uncased")
 
     args = parser.parse_args()
+    if args.accum_steps < 1:
+        parser.error("--accum_steps must be at least 1")
+    assert not args.cuda_graph or torch.cuda.is_available(), "CUDA graphs need a GPU"
+    assert not (args.cuda_graph and args.bucket), "A CUDA graph needs fixed-shape batches"
+    assert not (args.cuda_graph and args.accum_steps > 1), "The captured step always steps"
     main(args)
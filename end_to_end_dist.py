@@ -1,6 +1,7 @@
 import argparse
 import builtins
 import glob
+import importlib.util
 import os
 import time
 from functools import partial
@@ -107,7 +108,6 @@ def train_one_epoch(model, optimizer, train_loader, val_loader, args):
             print(f"[{i}] Loss: {loss.item()}")
             args.writer.add_scalar("Train/loss", loss.item(), args.iter)
 
-        torch.cuda.empty_cache()
         print(f"[{i}] Batch time: {time.time() - batch_start_time}")
         batch_start_time = time.time()
         args.iter += B
@@ -211,14 +211,19 @@ def main(args):
         transformer=args.model, embedding_dim=32, num_embeddings=len(id_to_ind)
     ).to(args.local_rank)
     model = DDP(model, device_ids=[args.local_rank], find_unused_parameters=True)
-    params = []
-    for n, p in model.named_parameters():
-        if "transformer" in n:
-            params.append({"params": p, "lr": args.lr / 10})
-        else:
-            params.append({"params": p, "lr": args.lr})
-
-    optimizer = Lion(params, lr=args.lr)
+    transformer_params = [p for n, p in model.named_parameters() if "transformer" in n]
+    other_params = [p for n, p in model.named_parameters() if "transformer" not in n]
+    params = [
+        {"params": transformer_params, "lr": args.lr / 10},
+        {"params": other_params, "lr": args.lr},
+    ]
+
+    if args.optimizer == "adamw":
+        # One fused CUDA kernel per param group
+        optimizer = torch.optim.AdamW(params, lr=args.lr, fused=True)
+    else:
+        # lion_pytorch falls back to a plain PyTorch step unless triton is importable
+        optimizer = Lion(params, lr=args.lr, use_triton=args.use_triton)
 
     if args.local_rank == 0:
         args.save_dir = f"checkpoints/{args.run_name}"
@@ -259,11 +264,13 @@ if __name__ == "__main__":
     parser.add_argument("--num_workers", type=int, default=2)
     parser.add_argument("--transform", type=bool, default=False)
     parser.add_argument("--local_rank", type=int, default=-1)
+    parser.add_argument("--optimizer", type=str, default="lion", choices=["lion", "adamw"])
 
     # Model
     parser.add_argument("--model", type=str, default="roberta-base")
 
     args = parser.parse_args()
+    args.use_triton = importlib.util.find_spec("triton") is not None
     if args.local_rank == -1:
         args.local_rank = int(os.environ["LOCAL_RANK"])
     main(args)
@@ -96,7 +96,6 @@ def train_one_epoch(model, optimizer, train_loader, val_loader, args):
             print(f"[{i}] Loss: {loss.item()}")
             args.writer.add_scalar("Train/loss", loss.item(), args.iter)
 
-        torch.cuda.empty_cache()
         print(f"[{i}] Batch time: {time.time() - batch_start_time}")
         batch_start_time = time.time()
         args.iter += B
@@ -58,7 +58,14 @@ def main():
     with torch.no_grad():
         for i, (string, x) in enumerate(tqdm(test_loader)):
             B = len(x)
-            out = model(string, x, "cuda")
+            inp = model.tokenizer(
+                string,
+                return_tensors="pt",
+                padding="max_length",
+                truncation=True,
+            )
+            inp = {k: v.to("cuda") for k, v in inp.items()}
+            out = model(inp, x.to("cuda"))
             out = out.detach().cpu().squeeze().numpy()
             test_preds.loc[total:total+B-1, 'PRODUCT_LENGTH'] = np.exp(out * test_set.std + test_set.mean)
             total += B
@@ -110,17 +110,10 @@ class TransformerEntityRegressorOld(nn.Module):
 
         self.regressor = Regressor(self.num_feature + self.embedding_dim)
 
-    def forward(self, string, type_id, device):
-        inp = self.tokenizer(
-            string,
-            return_tensors="pt",
-            padding="max_length",
-            truncation=True,
-        )
-        inp = {k: v.to(device) for k, v in inp.items()}
+    def forward(self, inp, type_id):
         output = self.transformer(**inp)
         cls = output[0][:, 0, :]
-        x = self.embedding(type_id.to(device))
+        x = self.embedding(type_id)
         x = self.regressor(torch.cat([cls, x], dim=1))
         return x
 
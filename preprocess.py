@@ -0,0 +1,81 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from transformers import BertTokenizerFast, RobertaTokenizerFast
+
+from dataset import token_paths
+
+
+def load_tokenizer(model):
+    if model == "bert-base-uncased" or model == "bert-base-cased":
+        return BertTokenizerFast.from_pretrained(model)
+    elif model == "roberta-base":
+        return RobertaTokenizerFast.from_pretrained(model)
+    raise ValueError(f"No tokenizer configured for model {model!r}")
+
+
+def tokenize_csv(path, model, max_length=512, chunk_size=10000):
+    tokenizer = load_tokenizer(model)
+    df = pd.read_csv(path, usecols=["TITLE", "BULLET_POINTS", "DESCRIPTION"])
+    ids_path, mask_path = token_paths(path, model)
+    # Written under a temporary name and renamed at the end, so an interrupted
+    # run never leaves a truncated cache behind
+    shape = (len(df), max_length)
+    input_ids = np.lib.format.open_memmap(
+        f"{ids_path}.tmp", mode="w+", dtype=np.int32, shape=shape
+    )
+    attention_mask = np.lib.format.open_memmap(
+        f"{mask_path}.tmp", mode="w+", dtype=np.int32, shape=shape
+    )
+
+    # The concatenated strings and their tokens are built one chunk at a time, so
+    # neither ever exists for the whole split at once
+    for start in tqdm(range(0, len(df), chunk_size)):
+        end = start + chunk_size
+        chunk = df.iloc[start:end]
+        strings = [
+            f"Title: {title}, Bullet Points: {bullet_points}, Description: {description}"
+            for title, bullet_points, description in zip(
+                chunk["TITLE"], chunk["BULLET_POINTS"], chunk["DESCRIPTION"]
+            )
+        ]
+        inp = tokenizer(
+            strings,
+            return_tensors="np",
+            padding="max_length",
+            truncation=True,
+            max_length=max_length,
+        )
+        input_ids[start:end] = inp["input_ids"]
+        attention_mask[start:end] = inp["attention_mask"]
+
+    input_ids.flush()
+    attention_mask.flush()
+    del input_ids, attention_mask
+    os.replace(f"{ids_path}.tmp", ids_path)
+    os.replace(f"{mask_path}.tmp", mask_path)
+    print(f"Saved {ids_path} and {mask_path}")
+
+
+def main(args):
+    for path in args.csv:
+        print(f"Tokenizing {path}")
+        tokenize_csv(path, args.model, args.max_length, args.chunk_size)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", type=str, default="bert-base-uncased")
+    parser.add_argument(
+        "--csv",
+        type=str,
+        nargs="+",
+        default=["dataset/train.csv", "dataset/split_train.csv", "dataset/split_val.csv"],
+    )
+    parser.add_argument("--max_length", type=int, default=512)
+    parser.add_argument("--chunk_size", type=int, default=10000)
+    args = parser.parse_args()
+    main(args)
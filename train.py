@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+import torch.nn.functional as F
 from model import Regressor
 from torch.utils.data import DataLoader, Dataset
 from torch import optim
@@ -17,6 +18,9 @@ class Trainer(nn.Module):
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         self.mean = 6.5502
         self.std = 0.9601
+        self.loss_fn = nn.MSELoss()
+        self.amp = self.device == "cuda"
+        self.amp_dtype = torch.bfloat16 if self.amp and torch.cuda.is_bf16_supported() else torch.float16
         self.get_model(self.args.features) # Creating Regressor
         if not pred:
             self.get_data(self.args.seed, self.args.batch_size) # Creating Dataloaders for Train and val
@@ -30,17 +34,25 @@ class Trainer(nn.Module):
 
     # Creating regressor
     def get_model(self, features=768):
-        self.regressor = Regressor(features).to(self.device, torch.float64)
+        self.regressor = Regressor(features).to(self.device)
+        if not self.args.no_compile and hasattr(self.regressor, "compile"):
+            # CUDA graph trees cost more than they save on a graph this small
+            self.regressor.compile(mode='max-autotune-no-cudagraphs')
 
     # Creating Dataloaders and Datasets
     def get_data(self, seed, batch_size):
-        self.trainloader = DataLoader(EmbeddingDataset(self.args.train_data_path, self.args.train_csv_path), batch_size=batch_size, shuffle=True)
-        self.valloader = DataLoader(EmbeddingDataset(self.args.val_data_path, self.args.val_csv_path), batch_size=batch_size, shuffle=False)
+        loader_kwargs = {'num_workers': self.args.num_workers, 'pin_memory': self.device == 'cuda'}
+        if self.args.num_workers > 0:
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+        self.trainloader = DataLoader(EmbeddingDataset(self.args.train_data_path, self.args.train_csv_path), batch_size=batch_size, shuffle=True, drop_last=True, **loader_kwargs)
+        self.valloader = DataLoader(EmbeddingDataset(self.args.val_data_path, self.args.val_csv_path), batch_size=batch_size, shuffle=False, **loader_kwargs)
 
     # Creating Optimizer
     def get_training_utils(self):
-        self.optimizer = optim.Adam(self.regressor.parameters(), lr=self.args.lr, amsgrad=True)
+        self.optimizer = optim.Adam(self.regressor.parameters(), lr=self.args.lr, amsgrad=True, fused=self.device == 'cuda')
         self.scheduler = optim.lr_scheduler.ReduceLROnPlateau(self.optimizer, 'min')
+        # bf16 has fp32's range so it needs no loss scaling; fp16 is the pre-Ampere fallback
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp and self.amp_dtype == torch.float16)
 
     # Forward pass
     def forward(self, x):
@@ -49,33 +61,45 @@ class Trainer(nn.Module):
     # Training loop for one epoch using complete trainset
     def train_epoch(self, epoch):
         self.regressor.train()
-        epoch_loss = 0
+        epoch_loss = torch.zeros((), device=self.device)
         initial_time = time.time()
         for batch_idx, (emb, val) in enumerate(self.trainloader):
-            self.optimizer.zero_grad()
-            output = self(emb.to(self.device, torch.float64)).squeeze(1)
-            loss = nn.MSELoss()(output, val.to(self.device, torch.float64))
-            epoch_loss += loss.item() 
-            loss.backward()
-            self.optimizer.step()
+            self.optimizer.zero_grad(set_to_none=True)
+            # Batches come from pinned memory, so these copies overlap with compute
+            emb = emb.to(self.device, non_blocking=True)
+            val = val.to(self.device, non_blocking=True)
+            with torch.cuda.amp.autocast(enabled=self.amp, dtype=self.amp_dtype):
+                output = self(emb).squeeze(1)
+                loss = self.loss_fn(output, val)
+            epoch_loss += loss.detach()
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        epoch_loss = epoch_loss.item()
         print('Train Epoch: {} Loss: {:.6f} LR: {} Time{}'.format(epoch, epoch_loss /(batch_idx + 1) , self.optimizer.param_groups[0]['lr'], time.time()-initial_time), flush=True)
         return epoch_loss / (batch_idx + 1)
 
     # valing loop for one epoch using complete valset
     def val(self, epoch):
         self.regressor.eval()
-        mape = 0
-        mse = 0
-        for _, (emb, val) in enumerate(self.valloader):
-            emb = emb.to(self.device, torch.float64)
-            val = val.to(self.device, torch.float64)
-            output = self(emb).squeeze(1)
-            output = torch.exp(output * self.std + self.mean)
-            val = torch.exp(val * self.std + self.mean)
-            mape += torch.sum(torch.abs(output-val) / (torch.abs(val) + 1e-8)).item()
-            mse += nn.MSELoss(reduction='sum')(output, val).item()
-        print("MAPE Loss at epoch {} is {}% and MSE Loss is {}".format(epoch, 100 * mape/len(self.valloader.dataset), mse/len(self.valloader.dataset)), flush=True)
-        return 100 * mape/len(self.valloader.dataset), mse/len(self.valloader.dataset)
+        # fp64 accumulators: sums of squared exp-scaled lengths quickly lose fp32 precision
+        mape = torch.zeros((), dtype=torch.float64, device=self.device)
+        mse = torch.zeros((), dtype=torch.float64, device=self.device)
+        with torch.no_grad():
+            for _, (emb, val) in enumerate(self.valloader):
+                emb = emb.to(self.device, non_blocking=True)
+                val = val.to(self.device, non_blocking=True)
+                with torch.cuda.amp.autocast(enabled=self.amp, dtype=self.amp_dtype):
+                    output = self(emb).squeeze(1)
+                output = output.float()
+                output = torch.exp(output * self.std + self.mean)
+                val = torch.exp(val * self.std + self.mean)
+                mape += ((output - val).abs() / val.abs().clamp_min(1e-8)).sum().double()
+                mse += F.mse_loss(output, val, reduction='sum').double()
+        total = len(self.valloader.dataset)
+        mape, mse = 100 * mape.item() / total, mse.item() / total
+        print("MAPE Loss at epoch {} is {}% and MSE Loss is {}".format(epoch, mape, mse), flush=True)
+        return mape, mse
 
     # Complete Training Loop
     def train(self):
@@ -126,10 +150,12 @@ def main():
     parser.add_argument('--batch_size', '-b', default=128, type=int)
     parser.add_argument('--features', '-f', default=768, type=int)
     parser.add_argument('--seed', '-r', default=421, type=int)
+    parser.add_argument('--num_workers', '-w', default=min(8, os.cpu_count() or 1), type=int)
     parser.add_argument('--log_interval', '-q', default=10000, type=int)
     parser.add_argument('--val_interval', '-t', default=5, type=int)
     parser.add_argument('--save', '-s', default='models/', type=str)
     parser.add_argument('--load_ckpt', '-lc', default=None, type=str)
+    parser.add_argument('--no_compile', action='store_true')
     args = parser.parse_args()
 
     # python train.py -dtr dataset/bert_base_uncased_train_embeddings.npy -dte dataset/bert_base_uncased_train_embeddings.npy -e 200 -b 64 -f 768 -q 10000 -t 5 -s model/
@@ -13,6 +13,7 @@ from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from tqdm import tqdm
 
+from checkpoint import keep_best, load_best_paths
 from dataset import TextDataset, EEDataset
 from model import EntityEmbedding, TransformerRegressor
 
@@ -49,23 +50,15 @@ def train(model, optimizer, train_loader, val_loader, args):
 
 
 def save_checkpoint(state, is_best, args):
-    torch.save(state, os.path.join(args.save_dir, f"epoch_{state['epoch']}.pth.tar"))
-    last_epoch_path = os.path.join(args.save_dir, f"epoch_{state['epoch'] - 1}.pth.tar")
-
-    try:
-        os.remove(last_epoch_path)
-    except OSError:
-        pass
+    path = os.path.join(args.save_dir, f"epoch_{state['epoch']}.pth.tar")
+    torch.save(state, path)
+    if args.last_path is not None:
+        os.remove(args.last_path)
+    args.last_path = path
 
     if is_best:
-        past_best = glob.glob(os.path.join(args.save_dir, "model_best_*.pth.tar"))
-        past_best = sorted(past_best, key=lambda x: int("".join(filter(str.isdigit, x))))
-        if len(past_best) >= 5:
-            try:
-                os.remove(past_best[0])
-            except:
-                pass
-        torch.save(state, os.path.join(args.save_dir, f"model_best_epoch_{state['epoch']}.pth.tar"))
+        best_path = os.path.join(args.save_dir, f"model_best_epoch_{state['epoch']}.pth.tar")
+        keep_best(path, best_path, args.best_paths)
 
 
 def train_one_epoch(model, optimizer, train_loader, val_loader, args):
@@ -92,7 +85,6 @@ def train_one_epoch(model, optimizer, train_loader, val_loader, args):
             # print(f"[{i}] Loss: {loss.item()}")
             args.writer.add_scalar("Train/loss", loss.item(), args.iter)
 
-        torch.cuda.empty_cache()
         # print(f"[{i}] Batch time: {time.time() - batch_start_time}")
         batch_start_time = time.time()
         args.iter += B
@@ -167,6 +159,8 @@ def main(args):
     os.makedirs(args.save_dir, exist_ok=True)
     os.makedirs(f"logs/{args.run_name}", exist_ok=True)
     args.writer = SummaryWriter(f"logs/{args.run_name}")
+    args.last_path = None
+    args.best_paths = load_best_paths(args.save_dir)
 
     if args.resume:
         print("Resuming from checkpoint")
@@ -176,6 +170,11 @@ def main(args):
         args.best_val_mape = state["best_val_mape"]
         args.start_epoch = state["epoch"] + 1
         args.iter = state["iter"]
+        # Like the old epoch_{e-1} cleanup: the next save replaces the resumed epoch's
+        # checkpoint (never --resume itself, which may be a model_best_* file)
+        last_path = os.path.join(args.save_dir, f"epoch_{state['epoch']}.pth.tar")
+        if os.path.exists(last_path):
+            args.last_path = last_path
     else:
         args.best_val_mape = np.inf
         args.start_epoch = 0